@@ -0,0 +1,146 @@
+"""_warehouse_io.py
+Helpers compartidos por desnormalizar.py y tablas.py: lectura CSV, escritura parquet, date_id YYYYMMDD y medidas float64.
+
+Se importa como módulo hermano (la carpeta script/ queda en sys.path al ejecutar cualquiera de los scripts).
+"""
+import csv
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pacsv
+except ImportError:  # sin pyarrow read_csv usa pandas y write_parquet falla (los scripts caen a CSV)
+    pa = pq = pacsv = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba es opcional: sin él se usa la versión numpy
+    njit = prange = None
+
+# leer CSV con el lector multihilo de pyarrow en lugar de pd.read_csv
+USE_ARROW_IO = True
+
+# kernels numba (paralelos) para date_id / line_total en hechos de al menos NUMBA_MIN_ROWS filas
+USE_NUMBA = njit is not None
+NUMBA_MIN_ROWS = 5_000_000
+
+# compresión parquet: zstd por defecto, configurable (ej. PARQUET_COMPRESSION=lz4 en discos NVMe)
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+PARQUET_OPTIONS = {
+    "compression": PARQUET_COMPRESSION,
+    "use_dictionary": True,
+    "data_page_size": 1 << 20,
+    "write_statistics": True,
+}
+if PARQUET_COMPRESSION == "zstd":
+    PARQUET_OPTIONS["compression_level"] = 3
+# filas por row group (unidad de lectura/poda para los consumidores)
+PARQUET_ROW_GROUP_SIZE = 256_000
+
+# Copy-on-Write: las copias defensivas de DataFrames se vuelven innecesarias (siempre activo en pandas >= 3.0)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+
+def canonical_name(c):
+    return c.strip().lower().replace(' ', '_') if isinstance(c, str) else c
+
+
+def is_date_column(c):
+    return c in ('order_date', 'created_at', 'fecha', 'date') or c.endswith('_date') or c.endswith('_at')
+
+
+def read_csv(p, date_strings=False, **read_kwargs):
+    """
+    Lee un CSV con pyarrow (multihilo, columnar) y lo convierte a pandas sin copias extra.
+    Si pyarrow no está disponible, USE_ARROW_IO es False o se pasan kwargs de pandas, usa pd.read_csv.
+    Con date_strings=True las columnas de fecha quedan como texto (igual que pd.read_csv) en vez de
+    convertirse a timestamp por la inferencia ISO de pyarrow.
+    """
+    if USE_ARROW_IO and pacsv is not None and not read_kwargs:
+        column_types = {}
+        if date_strings:
+            with open(p, encoding='utf-8', newline='') as f:
+                header = next(csv.reader(f), [])
+            column_types = {c: pa.string() for c in header if is_date_column(canonical_name(c))}
+        tbl = pacsv.read_csv(
+            p,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=64 << 20),
+            convert_options=pacsv.ConvertOptions(strings_can_be_null=True, column_types=column_types),
+        )
+        return tbl.to_pandas(split_blocks=True, self_destruct=True)
+    return pd.read_csv(p, encoding='utf-8', low_memory=False, **read_kwargs)
+
+
+def write_parquet(df, out):
+    """
+    Escribe df como parquet con pyarrow: PARQUET_OPTIONS, row groups de PARQUET_ROW_GROUP_SIZE filas y estadísticas.
+    Si la primera columna (surrogate key / id) está ordenada se declara en sorting_columns para que los lectores
+    puedan podar row groups por min/max.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sorted_first = len(df.columns) > 0 and df.iloc[:, 0].is_monotonic_increasing
+    pq.write_table(
+        table,
+        out,
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+        sorting_columns=[pq.SortingColumn(0)] if sorted_first else None,
+        **PARQUET_OPTIONS,
+    )
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _date_id_kernel(days, out):
+        """days (int64, días desde 1970-01-01) -> YYYYMMDD en out; algoritmo civil_from_days de H. Hinnant."""
+        for i in prange(days.shape[0]):
+            z = days[i] + 719468
+            era = z // 146097
+            doe = z - era * 146097
+            yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+            doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+            mp = (5 * doy + 2) // 153
+            day = doy - (153 * mp + 2) // 5 + 1
+            month = mp + 3 if mp < 10 else mp - 9
+            year = yoe + era * 400 + (1 if month <= 2 else 0)
+            out[i] = year * 10000 + month * 100 + day
+
+    @njit(parallel=True, cache=True)
+    def _multiply_kernel(a, b, out):
+        for i in prange(a.shape[0]):
+            out[i] = a[i] * b[i]
+
+
+def to_date_id(values):
+    """Convierte fechas a enteros YYYYMMDD con aritmética vectorizada sobre datetime64[D] (NaT -> <NA>)."""
+    dt = pd.to_datetime(values, errors='coerce')
+    d = dt.to_numpy(dtype='datetime64[D]')
+    nat = np.isnat(d)
+    d = np.where(nat, np.datetime64(0, 'D'), d)
+    if USE_NUMBA and len(d) >= NUMBA_MIN_ROWS:
+        ids = np.empty(len(d), dtype=np.int64)
+        _date_id_kernel(d.astype(np.int64), ids)
+    else:
+        month_start = d.astype('datetime64[M]')
+        y = d.astype('datetime64[Y]').astype(np.int64) + 1970
+        m = month_start.astype(np.int64) % 12 + 1
+        day = (d - month_start).astype(np.int64) + 1
+        ids = y * 10000 + m * 100 + day
+    return pd.Series(pd.arrays.IntegerArray(ids, nat), index=getattr(values, 'index', None))
+
+
+def as_float(values):
+    """Convierte una columna a un array float64 contiguo (valores no numéricos o faltantes -> NaN)."""
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def line_total(qty, price):
+    """qty * price como float64 (arrays de as_float); con USE_NUMBA y hechos muy grandes usa el kernel paralelo."""
+    if USE_NUMBA and len(qty) >= NUMBA_MIN_ROWS:
+        out = np.empty(len(qty), dtype=np.float64)
+        _multiply_kernel(qty, price, out)
+        return out
+    return np.multiply(qty, price)
@@ -4,10 +4,67 @@ Script: desnormalizar.py
 Función: desde los archivos raw genera tablas desnormalizadas (dimensiones + fact) y las guarda en /warehouse.
 Requisitos: pandas, pyarrow (para parquet). Ejecutar en Windows desde la carpeta del proyecto.
 """
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import os
+import re
 import sys
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pacsv
+except ImportError:  # pyarrow es opcional para leer CSV: se usa pandas
+    pa = ds = pq = pacsv = None
+
+from _warehouse_io import (
+    PARQUET_OPTIONS, USE_ARROW_IO, as_float, canonical_name, is_date_column, line_total, read_csv, to_date_id,
+    write_parquet,
+)
+
+# archivo raw -> nombre canónico de staging (el nombre del archivo contiene la palabra clave).
+# Gana la coincidencia más a la izquierda; en una misma posición se prueban primero las claves
+# más largas (sales_order_item antes que sales_order/order, product_category antes que product).
+STAGING_NAME_RULES = (
+    ("order_items", ("sales_order_item", "order_item")),
+    ("orders", ("sales_order", "order")),
+    ("customers", ("customer",)),
+    ("product_category", ("product_category",)),
+    ("products", ("product",)),
+    ("stores", ("store", "channel")),
+    ("payment", ("payment",)),
+    ("shipment", ("shipment",)),
+    ("web_session", ("web_session",)),
+    ("nps_response", ("nps_response",)),
+    ("province", ("province",)),
+    ("address", ("address",)),
+)
+STAGING_NAME_PATTERN = re.compile("|".join(f"(?P<{target}>{'|'.join(keys)})" for target, keys in STAGING_NAME_RULES))
+
+# CSVs raw más grandes que esto se pasan a parquet por lotes, sin cargarlos enteros en memoria
+STREAM_CSV_MIN_BYTES = 512 << 20
+STREAM_BATCH_ROWS = 200_000
+
+# hilos para procesar archivos raw en build_staging (pyarrow libera el GIL al leer y comprimir)
+STAGING_WORKERS = os.cpu_count() or 1
+
+# formatos ISO (no ambiguos) que se detectan por columna para evitar la inferencia por valor;
+# los formatos con barras (día/mes vs mes/día) se dejan a la inferencia de pandas
+DATE_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d",
+)
+
+# columnas que necesita fact_order_lines: claves/fechas y candidatas (case-insensitive) a cantidad y precio
+FACT_KEY_COLUMNS = ("order_id", "customer_id", "product_id", "store_id", "order_date", "date")
+QTY_COLUMNS = ("quantity", "qty", "units")
+PRICE_COLUMNS = ("price", "unit_price", "unitprice", "precio")
+
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 RAW_DIR = PROJECT_ROOT / "raw"
 DWH_DIR = PROJECT_ROOT / "warehouse"
@@ -35,13 +92,47 @@ def read_table(name, **read_kwargs):
     if p.suffix == ".parquet":
         return pd.read_parquet(p, **read_kwargs)
     else:
-        return pd.read_csv(p, **read_kwargs)
+        # las dimensiones conservan las fechas como texto (mismo esquema que con pd.read_csv)
+        return read_csv(p, date_strings=True, **read_kwargs)
 
 
 def _canonicalize_columns(df):
-    """Lowercase, strip spaces and replace spaces with underscore for staging."""
-    df = df.copy()
-    df.columns = [c.strip().lower().replace(' ', '_') if isinstance(c, str) else c for c in df.columns]
+    """Lowercase, strip spaces and replace spaces with underscore for staging (renames in place, no data copy)."""
+    df.columns = [canonical_name(c) for c in df.columns]
+    return df
+
+
+def _sniff_date_format(sample):
+    """Devuelve el primer formato de DATE_FORMATS que parsea sample, o None para que pandas lo infiera."""
+    if not isinstance(sample, str):
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            datetime.strptime(sample, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_dates(df):
+    """Parsea las columnas de fecha comunes con un formato fijo por columna (o inferido si no es ISO)."""
+    date_cols = [c for c in df.columns if is_date_column(c)]
+    for c in date_cols:
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            # ya parseada (ej. timestamps ISO detectados por el lector de pyarrow)
+            continue
+        try:
+            first = s.first_valid_index()
+            fmt = _sniff_date_format(s[first]) if first is not None else None
+            parsed = pd.to_datetime(s, format=fmt, errors='coerce', cache=True)
+            if fmt is not None and parsed.isna().sum() > s.isna().sum():
+                # el formato detectado no sirve para toda la columna: no perder valores, inferir
+                parsed = pd.to_datetime(s, errors='coerce', cache=True)
+            df[c] = parsed
+        except Exception:
+            pass
     return df
 
 
@@ -51,10 +142,86 @@ def write_staging(df, name):
         print(f"[info] staging {name} vacía, no se guarda.")
         return
     out = STAGING_DIR / f"{name}.parquet"
-    df.to_parquet(out, index=False)
+    write_parquet(df, out)
     print(f"[ok] guardado staging {out} rows={len(df)}")
 
 
+def _stream_csv_to_staging(p, target):
+    """
+    Escribe un CSV grande como staging parquet lote a lote (pico de memoria = un lote), sin pasar por pandas.
+    Las columnas se canonicalizan y las fechas ISO se parsean en el lector de Arrow (DATE_FORMATS); el resto queda como texto.
+    """
+    csv_format = ds.CsvFileFormat(
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=64 << 20),
+        convert_options=pacsv.ConvertOptions(
+            strings_can_be_null=True,
+            timestamp_parsers=[pacsv.ISO8601, *DATE_FORMATS],
+        ),
+    )
+    dataset = ds.dataset(p, format=csv_format)
+    schema = pa.schema([f.with_name(canonical_name(f.name)) for f in dataset.schema])
+    out = STAGING_DIR / f"{target}.parquet"
+    rows = 0
+    with pq.ParquetWriter(out, schema, **PARQUET_OPTIONS) as writer:
+        for batch in dataset.to_batches(batch_size=STREAM_BATCH_ROWS):
+            writer.write_batch(pa.RecordBatch.from_arrays(batch.columns, schema=schema))
+            rows += batch.num_rows
+    if rows == 0:
+        out.unlink()
+        print(f"[info] staging {target} vacía, no se guarda.")
+        return
+    print(f"[ok] guardado staging {out} rows={rows} (streaming)")
+
+
+def _stage_file(p, target):
+    """Lee un archivo raw, normaliza columnas y fechas y lo escribe como staging target."""
+    if USE_ARROW_IO and ds is not None and p.suffix == '.csv' and p.stat().st_size > STREAM_CSV_MIN_BYTES:
+        try:
+            _stream_csv_to_staging(p, target)
+            return True
+        except Exception as e:
+            print(f"[warn] no se pudo convertir {p.name} por lotes, se lee completo: {e}", file=sys.stderr)
+
+    try:
+        if p.suffix == '.parquet':
+            df = pd.read_parquet(p)
+        else:
+            # robust CSV read
+            df = read_csv(p)
+    except Exception as e:
+        print(f"[warn] no se pudo leer {p.name}: {e}", file=sys.stderr)
+        return False
+
+    # canonicalize columns
+    df = _canonicalize_columns(df)
+
+    # try to parse common date columns
+    df = _parse_dates(df)
+
+    # safe write: try parquet, fallback to csv if pyarrow missing
+    try:
+        write_staging(df, target)
+    except Exception as e:
+        try:
+            out = STAGING_DIR / f"{target}.csv"
+            df.to_csv(out, index=False, encoding='utf-8')
+            print(f"[ok] guardado staging {out} rows={len(df)} (csv fallback)")
+        except Exception as ex:
+            print(f"[error] no se pudo guardar staging {target}: {ex}", file=sys.stderr)
+            return False
+    return True
+
+
+def _stage_target(target, files):
+    """Genera el staging target con el primer archivo de files que se pueda procesar."""
+    for i, p in enumerate(files):
+        if _stage_file(p, target):
+            for skipped in files[i + 1:]:
+                print(f"[info] ya procesado {target}, salto {skipped.name}")
+            return True
+    return False
+
+
 def build_staging():
     """Read raw files, normalize column names and types, and write staging parquet tables.
 
@@ -66,76 +233,21 @@ def build_staging():
         print(f"[warn] no hay archivos en {RAW_DIR}", file=sys.stderr)
         return False
 
-    # simple mapping rules: filename contains keyword -> canonical name
-    mapping_rules = {
-        'customer': 'customers',
-        'product': 'products',
-        'store': 'stores',
-        'channel': 'stores',
-        'order_item': 'order_items',
-        'sales_order_item': 'order_items',
-        'sales_order': 'orders',
-        'sales_order_item': 'order_items',
-        'order': 'orders',
-        'payment': 'payment',
-        'shipment': 'shipment',
-        'web_session': 'web_session',
-        'nps_response': 'nps_response',
-        'province': 'province',
-        'product_category': 'product_category',
-        'address': 'address'
-    }
-
-    processed = set()
-
+    # target -> archivos candidatos en orden de glob: si uno falla se prueba el siguiente
+    candidates = {}
     for p in raw_files:
         name = p.stem.lower()
         # find best mapping
-        target = None
-        for k, v in mapping_rules.items():
-            if k in name:
-                target = v
-                break
-        if target is None:
-            target = name
-
-        if target in processed:
-            print(f"[info] ya procesado {target}, salto {p.name}")
-            continue
+        m = STAGING_NAME_PATTERN.search(name)
+        target = m.lastgroup if m else name
+        candidates.setdefault(target, []).append(p)
 
-        try:
-            if p.suffix == '.parquet':
-                df = pd.read_parquet(p)
-            else:
-                # robust CSV read
-                df = pd.read_csv(p, encoding='utf-8', low_memory=False)
-        except Exception as e:
-            print(f"[warn] no se pudo leer {p.name}: {e}", file=sys.stderr)
-            continue
-
-        # canonicalize columns
-        df = _canonicalize_columns(df)
-
-        # try to parse common date columns
-        for c in list(df.columns):
-            if c in ('order_date', 'created_at', 'fecha', 'date') or c.endswith('_date') or c.endswith('_at'):
-                try:
-                    df[c] = pd.to_datetime(df[c], errors='coerce')
-                except Exception:
-                    pass
-
-        # safe write: try parquet, fallback to csv if pyarrow missing
-        try:
-            write_staging(df, target)
-        except Exception as e:
-            try:
-                out = STAGING_DIR / f"{target}.csv"
-                df.to_csv(out, index=False, encoding='utf-8')
-                print(f"[ok] guardado staging {out} rows={len(df)} (csv fallback)")
-            except Exception as ex:
-                print(f"[error] no se pudo guardar staging {target}: {ex}", file=sys.stderr)
-
-        processed.add(target)
+    # cada target es independiente: lectura, parseo y escritura parquet (zstd) en paralelo
+    with ThreadPoolExecutor(max_workers=min(len(candidates), STAGING_WORKERS)) as ex:
+        futures = {target: ex.submit(_stage_target, target, files) for target, files in candidates.items()}
+        for target, fut in futures.items():
+            if not fut.result():
+                print(f"[warn] no se pudo generar staging {target}", file=sys.stderr)
 
     return True
 
@@ -144,7 +256,7 @@ def write_table(df, name):
         print(f"[info] tabla {name} vacía, no se guarda.")
         return
     out = DWH_DIR / f"{name}.parquet"
-    df.to_parquet(out, index=False)
+    write_parquet(df, out)
     print(f"[ok] guardado {out} rows={len(df)}")
 
 def build_dimensions():
@@ -154,7 +266,7 @@ def build_dimensions():
         customers_dim = customers.drop_duplicates().reset_index(drop=True)
         # normalizar nombres y key surrogate si no existe
         if "customer_id" not in customers_dim.columns:
-            customers_dim.insert(0, "customer_id", range(1, len(customers_dim)+1))
+            customers_dim.insert(0, "customer_id", np.arange(1, len(customers_dim)+1, dtype=np.int32))
         write_table(customers_dim, "dim_customers")
     else:
         customers_dim = None
@@ -164,7 +276,7 @@ def build_dimensions():
     if products is not None:
         products_dim = products.drop_duplicates().reset_index(drop=True)
         if "product_id" not in products_dim.columns:
-            products_dim.insert(0, "product_id", range(1, len(products_dim)+1))
+            products_dim.insert(0, "product_id", np.arange(1, len(products_dim)+1, dtype=np.int32))
         write_table(products_dim, "dim_products")
     else:
         products_dim = None
@@ -174,7 +286,7 @@ def build_dimensions():
     if stores is not None:
         stores_dim = stores.drop_duplicates().reset_index(drop=True)
         if "store_id" not in stores_dim.columns:
-            stores_dim.insert(0, "store_id", range(1, len(stores_dim)+1))
+            stores_dim.insert(0, "store_id", np.arange(1, len(stores_dim)+1, dtype=np.int32))
         write_table(stores_dim, "dim_stores")
     else:
         stores_dim = None
@@ -186,8 +298,8 @@ def build_dimensions():
         orders = read_table("orders")
         if orders is not None and "order_date" in orders.columns:
             dates = pd.DataFrame({"date": pd.to_datetime(orders["order_date"]).dt.date.unique()})
+            # date_id se calcula abajo como YYYYMMDD: la misma clave int que usa el fact para el join
             dates = dates.sort_values("date").reset_index(drop=True)
-            dates["date_id"] = range(1, len(dates)+1)
         else:
             dates = None
 
@@ -201,7 +313,7 @@ def build_dimensions():
                         dates = dates.rename(columns={c: "date"})
                         break
             dates["date"] = pd.to_datetime(dates["date"])
-            dates["date_id"] = dates["date"].dt.strftime("%Y%m%d").astype(int)
+            dates["date_id"] = to_date_id(dates["date"])
             dates["year"] = dates["date"].dt.year
             dates["month"] = dates["date"].dt.month
             dates["day"] = dates["date"].dt.day
@@ -216,6 +328,16 @@ def build_dimensions():
         "dates": dates
     }
 
+def _first_column(cmap, candidates):
+    """Devuelve la candidata presente en cmap que aparece primero en el frame, o None."""
+    found = [cmap[k] for k in candidates if k in cmap]
+    return min(found)[1] if found else None
+
+def _project_fact_columns(df):
+    """Se queda con las claves, fechas y columnas candidatas a medidas que usa fact_order_lines."""
+    keep = [c for c in df.columns if c in FACT_KEY_COLUMNS or c.lower() in QTY_COLUMNS + PRICE_COLUMNS]
+    return df[keep]
+
 def build_fact_order_lineitems(dims):
     """
     Construye fact_orders (a nivel de línea de pedido) juntando orders + order_items + dimensiones.
@@ -228,39 +350,47 @@ def build_fact_order_lineitems(dims):
 
     # homogeneizar claves
     # suponer order_id, product_id, customer_id, store_id, order_date, quantity, price
-    df = items.merge(orders, on="order_id", how="left", suffixes=("_item", "_order"))
+    # proyectar antes de cada merge: sólo viajan claves, fechas y candidatas a medidas
+    df = _project_fact_columns(items).merge(_project_fact_columns(orders), on="order_id", how="left", suffixes=("_item", "_order"))
 
     # merge dimensiones si están disponibles
     if dims.get("customers") is not None and "customer_id" in df.columns:
-        df = df.merge(dims["customers"], on="customer_id", how="left", suffixes=("", "_cust"))
+        df = df.merge(_project_fact_columns(dims["customers"]), on="customer_id", how="left", suffixes=("", "_cust"))
     if dims.get("products") is not None and "product_id" in df.columns:
-        df = df.merge(dims["products"], on="product_id", how="left", suffixes=("", "_prod"))
+        df = df.merge(_project_fact_columns(dims["products"]), on="product_id", how="left", suffixes=("", "_prod"))
     if dims.get("stores") is not None and "store_id" in df.columns:
-        df = df.merge(dims["stores"], on="store_id", how="left", suffixes=("", "_store"))
+        df = df.merge(_project_fact_columns(dims["stores"]), on="store_id", how="left", suffixes=("", "_store"))
     if dims.get("dates") is not None:
         # crear date_id desde order_date si existe
         if "order_date" in df.columns:
-            df["order_date"] = pd.to_datetime(df["order_date"])
-            df["date_id"] = df["order_date"].dt.strftime("%Y%m%d").astype(int)
+            df["date_id"] = to_date_id(df["order_date"])
         elif "date" in df.columns:
-            df["date_id"] = pd.to_datetime(df["date"]).dt.strftime("%Y%m%d").astype(int)
+            df["date_id"] = to_date_id(df["date"])
 
     # calcular medidas
     # buscar columnas de cantidad y precio
-    qty_col = next((c for c in df.columns if c.lower() in ("quantity", "qty", "units")), None)
-    price_col = next((c for c in df.columns if c.lower() in ("price", "unit_price", "unitprice", "precio")), None)
-    df["quantity"] = df[qty_col] if qty_col in df.columns else 1
-    if price_col in df.columns:
+    # nombre en minúsculas -> (posición, columna) de su primera aparición: lookup O(1) por candidata,
+    # y entre candidatas gana la que aparece antes en el frame (ítems antes que dimensiones)
+    cmap = {}
+    for i, c in enumerate(df.columns):
+        cmap.setdefault(c.lower(), (i, c))
+    qty_col = _first_column(cmap, QTY_COLUMNS)
+    price_col = _first_column(cmap, PRICE_COLUMNS)
+    df["quantity"] = df[qty_col] if qty_col is not None else 1
+    # medidas como float64 (NaN si falta el precio) para no generar columnas object
+    qty = as_float(df["quantity"])
+    if price_col is not None:
         df["unit_price"] = df[price_col]
-        df["line_total"] = df["quantity"] * df["unit_price"]
+        price = as_float(df["unit_price"])
     else:
-        df["unit_price"] = None
-        df["line_total"] = None
+        price = np.full(len(df), np.nan)
+        df["unit_price"] = price
+    df["line_total"] = line_total(qty, price)
 
     # seleccionar columnas relevantes para el fact
     preserve = ["order_id", "date_id", "customer_id", "product_id", "store_id", "quantity", "unit_price", "line_total"]
     preserve = [c for c in preserve if c in df.columns]
-    fact = df[preserve].copy().drop_duplicates().reset_index(drop=True)
+    fact = df[preserve].drop_duplicates().reset_index(drop=True)
     write_table(fact, "fact_order_lines")
     return fact
 
@@ -20,32 +20,55 @@ Hechos creados:
 El script intenta leer parquet (.parquet) primero, cae a CSV si no existe.
 """
 from pathlib import Path
+import gc
+import numpy as np
 import pandas as pd
 import sys
 
+from _warehouse_io import as_float, line_total, read_csv, to_date_id, write_parquet
+
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 STAGING_DIR = PROJECT_ROOT / "warehouse" / "staging"
 DWH_DIR = PROJECT_ROOT / "warehouse"
 
+# tablas de staging ya leídas (una lectura por archivo); se liberan con _release_staging
+_STAGING_CACHE = {}
 
-def read_staging(name):
+
+def _load_staging(name):
     p_par = STAGING_DIR / f"{name}.parquet"
     p_csv = STAGING_DIR / f"{name}.csv"
     if p_par.exists():
         return pd.read_parquet(p_par)
     if p_csv.exists():
-        return pd.read_csv(p_csv, encoding='utf-8', low_memory=False)
+        # fechas como texto (mismo esquema que pd.read_csv); se parsean donde hace falta
+        return read_csv(p_csv, date_strings=True)
     print(f"[warn] staging {name} no encontrado en {STAGING_DIR}", file=sys.stderr)
     return None
 
 
+def read_staging(name):
+    """Lee una tabla de staging una sola vez; las llamadas siguientes devuelven una copia perezosa (CoW) del cache."""
+    if name not in _STAGING_CACHE:
+        _STAGING_CACHE[name] = _load_staging(name)
+    df = _STAGING_CACHE[name]
+    return df.copy(deep=False) if df is not None else None
+
+
+def _release_staging(*names):
+    """Saca tablas del cache de staging para que su memoria se libere apenas nadie más las referencie."""
+    for name in names:
+        _STAGING_CACHE.pop(name, None)
+    gc.collect()
+
+
 def write_table(df, name):
     if df is None or df.empty:
         print(f"[info] tabla {name} vacía, no se guarda.")
         return
     out = DWH_DIR / f"{name}.parquet"
     try:
-        df.to_parquet(out, index=False)
+        write_parquet(df, out)
         print(f"[ok] guardado {out} rows={len(df)}")
     except Exception as e:
         # fallback to csv if parquet engine missing
@@ -62,13 +85,38 @@ def _ensure_datetime(df, col):
         df[col] = pd.to_datetime(df[col], errors='coerce')
 
 
+def _categorize_key(dim, key):
+    """Convierte la natural key de una dimensión a category para que los lookups comparen códigos int."""
+    if key in dim.columns:
+        dim[key] = dim[key].astype('category')
+
+
+def _sk_map(df, dim, key, sk):
+    """Agrega a df la surrogate key sk de dim resolviendo key por códigos de category (sin merge ni copia del frame)."""
+    keys = dim[key]
+    if not isinstance(keys.dtype, pd.CategoricalDtype):
+        keys = keys.astype('category')
+    dim_codes = keys.cat.codes.to_numpy()
+    valid = dim_codes >= 0
+    sk_by_code = np.zeros(len(keys.cat.categories), dtype=dim[sk].dtype)
+    sk_by_code[dim_codes[valid]] = dim[sk].to_numpy()[valid]
+    codes = keys.cat.categories.get_indexer(df[key])
+    found = codes >= 0
+    if found.all():
+        df[sk] = sk_by_code[codes]
+    elif found.any():
+        df[sk] = np.where(found, sk_by_code[np.maximum(codes, 0)], np.nan)
+    else:
+        df[sk] = np.nan
+
+
 def build_dimensions():
     dims = {}
 
     # dim_customers
     customers = read_staging('customers')
     if customers is not None:
-        c = customers.copy()
+        c = customers
         # canonical columns
         if 'customer_id' not in c.columns and 'id' in c.columns:
             c = c.rename(columns={'id': 'customer_id'})
@@ -78,8 +126,9 @@ def build_dimensions():
             c = c.drop_duplicates(subset=['customer_id']).reset_index(drop=True)
         else:
             c = c.drop_duplicates().reset_index(drop=True)
-        c.insert(0, 'customer_sk', range(1, len(c)+1))
+        c.insert(0, 'customer_sk', np.arange(1, len(c)+1, dtype=np.int32))
         write_table(c, 'dim_customers')
+        _categorize_key(c, 'customer_id')
         dims['customers'] = c
     else:
         dims['customers'] = None
@@ -87,14 +136,15 @@ def build_dimensions():
     # dim_products
     products = read_staging('products')
     if products is not None:
-        p = products.copy()
+        p = products
         _ensure_datetime(p, 'created_at')
         if 'product_id' in p.columns:
             p = p.drop_duplicates(subset=['product_id']).reset_index(drop=True)
         else:
             p = p.drop_duplicates().reset_index(drop=True)
-        p.insert(0, 'product_sk', range(1, len(p)+1))
+        p.insert(0, 'product_sk', np.arange(1, len(p)+1, dtype=np.int32))
         write_table(p, 'dim_products')
+        _categorize_key(p, 'product_id')
         dims['products'] = p
     else:
         dims['products'] = None
@@ -104,7 +154,7 @@ def build_dimensions():
     if stores is None:
         stores = read_staging('channels')
     if stores is not None:
-        s = stores.copy()
+        s = stores
         # some staging use channel_id as natural key
         if 'store_id' not in s.columns and 'channel_id' in s.columns:
             s = s.rename(columns={'channel_id': 'store_id'})
@@ -112,34 +162,34 @@ def build_dimensions():
             s = s.drop_duplicates(subset=['store_id']).reset_index(drop=True)
         else:
             s = s.drop_duplicates().reset_index(drop=True)
-        s.insert(0, 'store_sk', range(1, len(s)+1))
+        s.insert(0, 'store_sk', np.arange(1, len(s)+1, dtype=np.int32))
         write_table(s, 'dim_stores')
+        _categorize_key(s, 'store_id')
         dims['stores'] = s
     else:
         dims['stores'] = None
 
-    # dim_date - build from any date columns in staging (orders.created_at/order_date, customers.created_at, products.created_at)
-    dates = None
-    orders = read_staging('orders')
-    if orders is not None and 'order_date' in orders.columns:
-        dates = pd.DataFrame({'date': pd.to_datetime(orders['order_date'], errors='coerce').dt.normalize().dropna().unique()})
-    # fallback: customers.created_at
-    if dates is None or dates.empty:
-        if customers is not None and 'created_at' in customers.columns:
-            dates = pd.DataFrame({'date': pd.to_datetime(customers['created_at'], errors='coerce').dt.normalize().dropna().unique()})
-    if dates is None or dates.empty:
-        # create small default calendar from min/max of orders if available
-        if orders is not None and 'order_date' in orders.columns:
-            rng = pd.to_datetime(orders['order_date'], errors='coerce')
-            mn = rng.min()
-            mx = rng.max()
-            if pd.notna(mn) and pd.notna(mx):
-                dates = pd.DataFrame({'date': pd.date_range(mn.normalize(), mx.normalize(), freq='D')})
+    # dim_date - build from every date column the facts map to date_sk, collected with a single np.unique
+    date_sources = (
+        ('orders', 'order_date'),
+        ('customers', 'created_at'),
+        ('payment', 'created_at'),
+        ('shipment', 'shipped_at'),
+        ('web_session', 'started_at'),
+        ('nps_response', 'response_date'),
+    )
+    parts = []
+    for name, col in date_sources:
+        src = read_staging(name)
+        if src is not None and col in src.columns:
+            days = pd.to_datetime(src[col], errors='coerce').dt.normalize().dropna()
+            parts.append(np.unique(days.to_numpy(dtype='datetime64[ns]')))
+    # np.unique ya devuelve las fechas ordenadas y el DataFrame nuevo tiene RangeIndex: no hace falta sort/reset
+    dates = pd.DataFrame({'date': np.unique(np.concatenate(parts))}) if parts else None
     if dates is not None and not dates.empty:
-        dates = dates.sort_values('date').reset_index(drop=True)
         dates['date'] = pd.to_datetime(dates['date'])
-        dates.insert(0, 'date_sk', range(1, len(dates)+1))
-        dates['date_id'] = dates['date'].dt.strftime('%Y%m%d').astype(int)
+        dates.insert(0, 'date_sk', np.arange(1, len(dates)+1, dtype=np.int32))
+        dates['date_id'] = to_date_id(dates['date']).astype('int64')  # fechas sin NaT (dropna arriba)
         dates['year'] = dates['date'].dt.year
         dates['month'] = dates['date'].dt.month
         dates['day'] = dates['date'].dt.day
@@ -152,12 +202,12 @@ def build_dimensions():
     # dim_address
     address = read_staging('address')
     if address is not None:
-        a = address.copy()
+        a = address
         if 'address_id' in a.columns:
             a = a.drop_duplicates(subset=['address_id']).reset_index(drop=True)
         else:
             a = a.drop_duplicates().reset_index(drop=True)
-        a.insert(0, 'address_sk', range(1, len(a)+1))
+        a.insert(0, 'address_sk', np.arange(1, len(a)+1, dtype=np.int32))
         write_table(a, 'dim_address')
         dims['address'] = a
     else:
@@ -166,34 +216,40 @@ def build_dimensions():
     # dim_product_category
     pc = read_staging('product_category')
     if pc is not None:
-        cat = pc.copy()
+        cat = pc
         # assume category_id exists
         if 'category_id' in cat.columns:
             cat = cat.drop_duplicates(subset=['category_id']).reset_index(drop=True)
         else:
             cat = cat.drop_duplicates().reset_index(drop=True)
-        cat.insert(0, 'product_category_sk', range(1, len(cat)+1))
+        cat.insert(0, 'product_category_sk', np.arange(1, len(cat)+1, dtype=np.int32))
         write_table(cat, 'dim_product_category')
         dims['product_category'] = cat
     else:
         dims['product_category'] = None
 
+    # el staging que sólo usan las dimensiones ya no hace falta
+    _release_staging('customers', 'products', 'stores', 'channels', 'address', 'product_category')
     return dims
 
 
-def build_facts(dims):
-    # fact_order_lines
+def _read_orders():
+    orders = read_staging('orders')
+    if orders is None:
+        orders = read_staging('sales_order')
+    return orders
+
+
+def _build_fact_order_lines(dims, date_sk_by_id):
     items = read_staging('order_items')
     if items is None:
         items = read_staging('sales_order_item')
-    if items is None:
-        items = read_staging('sales_order_item')
 
-    orders = read_staging('orders')
-    if orders is None:
-        orders = read_staging('sales_order')
+    orders = _read_orders()
     if items is not None:
-        f = items.copy()
+        # proyectar antes del merge: sólo claves y medidas que usa el fact
+        line_cols = ('order_id', 'product_id', 'customer_id', 'store_id', 'order_date', 'quantity', 'qty', 'unit_price', 'price', 'line_total')
+        f = items[[c for c in items.columns if c in line_cols]]
         # merge order header to get order_date, customer_id, store_id
         if orders is not None and 'order_id' in orders.columns:
             f = f.merge(orders[['order_id', 'order_date', 'customer_id', 'store_id']], on='order_id', how='left')
@@ -206,127 +262,129 @@ def build_facts(dims):
 
         # map to surrogate keys from dims
         if dims.get('customers') is not None and 'customer_id' in f.columns:
-            f = f.merge(dims['customers'][['customer_sk', 'customer_id']], on='customer_id', how='left')
+            _sk_map(f, dims['customers'], 'customer_id', 'customer_sk')
         if dims.get('products') is not None and 'product_id' in f.columns:
-            f = f.merge(dims['products'][['product_sk', 'product_id']], on='product_id', how='left')
+            _sk_map(f, dims['products'], 'product_id', 'product_sk')
         if dims.get('stores') is not None and 'store_id' in f.columns:
-            f = f.merge(dims['stores'][['store_sk', 'store_id']], on='store_id', how='left')
+            _sk_map(f, dims['stores'], 'store_id', 'store_sk')
 
         # date dimension mapping
-        if dims.get('dates') is not None:
+        if date_sk_by_id is not None:
             if 'order_date' in f.columns:
-                f['order_date'] = pd.to_datetime(f['order_date'], errors='coerce')
-                f = f.merge(dims['dates'][['date_sk', 'date', 'date_id']], left_on=pd.to_datetime(f['order_date']).dt.normalize(), right_on='date', how='left')
-                # keep date_sk
-                if 'date_sk' in f.columns:
-                    f = f.rename(columns={'date_sk': 'order_date_sk'})
-                # drop helper cols
-                f = f.drop(columns=[col for col in ('key_0','date') if col in f.columns])
+                f['order_date_sk'] = to_date_id(f['order_date']).map(date_sk_by_id)
 
         # compute measures
         if 'quantity' not in f.columns:
             f['quantity'] = 1
         if 'unit_price' in f.columns:
-            f['line_total'] = f['quantity'] * f['unit_price']
+            f['line_total'] = line_total(as_float(f['quantity']), as_float(f['unit_price']))
         else:
             if 'line_total' not in f.columns:
-                f['line_total'] = None
+                f['line_total'] = np.nan
 
         # select common fact columns
         cols = [c for c in ['order_id', 'order_date_sk', 'customer_sk', 'product_sk', 'store_sk', 'quantity', 'unit_price', 'line_total'] if c in f.columns]
-        fact_lines = f[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_lines = f[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_lines, 'fact_order_lines')
     else:
         print('[warn] no hay order_items para crear fact_order_lines')
 
-    # fact_orders
+
+def _build_fact_orders(dims, date_sk_by_id):
+    orders = _read_orders()
     if orders is not None:
-        o = orders.copy()
+        order_cols = ('order_id', 'order_date', 'customer_id', 'store_id', 'status', 'subtotal', 'tax_amount', 'shipping_fee', 'total_amount')
+        o = orders[[c for c in orders.columns if c in order_cols]]
         # map customer and store
         if dims.get('customers') is not None and 'customer_id' in o.columns:
-            o = o.merge(dims['customers'][['customer_sk', 'customer_id']], on='customer_id', how='left')
+            _sk_map(o, dims['customers'], 'customer_id', 'customer_sk')
         if dims.get('stores') is not None and 'store_id' in o.columns:
-            o = o.merge(dims['stores'][['store_sk', 'store_id']], on='store_id', how='left')
+            _sk_map(o, dims['stores'], 'store_id', 'store_sk')
         # map date
-        if dims.get('dates') is not None and 'order_date' in o.columns:
-            o['order_date'] = pd.to_datetime(o['order_date'], errors='coerce')
-            o = o.merge(dims['dates'][['date_sk','date']], left_on=pd.to_datetime(o['order_date']).dt.normalize(), right_on='date', how='left')
-            if 'date_sk' in o.columns:
-                o = o.rename(columns={'date_sk': 'order_date_sk'})
-            o = o.drop(columns=[col for col in ('key_0','date') if col in o.columns])
+        if date_sk_by_id is not None and 'order_date' in o.columns:
+            o['order_date_sk'] = to_date_id(o['order_date']).map(date_sk_by_id)
 
         # select
         cols = [c for c in ['order_id','order_date_sk','customer_sk','store_sk','status','subtotal','tax_amount','shipping_fee','total_amount'] if c in o.columns]
-        fact_orders = o[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_orders = o[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_orders, 'fact_orders')
     else:
         print('[warn] no hay orders para crear fact_orders')
 
-    # fact_payments
+
+def _build_fact_payments(date_sk_by_id):
     payments = read_staging('payment')
     if payments is not None:
-        pay = payments.copy()
-        if 'order_id' in pay.columns and dims.get('dates') is not None and 'created_at' in pay.columns:
-            pay['created_at'] = pd.to_datetime(pay['created_at'], errors='coerce')
-            pay = pay.merge(dims['dates'][['date_sk','date']], left_on=pd.to_datetime(pay['created_at']).dt.normalize(), right_on='date', how='left')
-            if 'date_sk' in pay.columns:
-                pay = pay.rename(columns={'date_sk':'payment_date_sk'})
-            pay = pay.drop(columns=[col for col in ('key_0','date') if col in pay.columns])
+        pay = payments
+        if 'order_id' in pay.columns and date_sk_by_id is not None and 'created_at' in pay.columns:
+            pay['payment_date_sk'] = to_date_id(pay['created_at']).map(date_sk_by_id)
         cols = [c for c in ['payment_id','order_id','payment_date_sk','amount','status','payment_method'] if c in pay.columns]
-        fact_pay = pay[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_pay = pay[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_pay, 'fact_payments')
     else:
         print('[warn] no hay payment para crear fact_payments')
 
-    # fact_shipments
+
+def _build_fact_shipments(date_sk_by_id):
     shipments = read_staging('shipment')
     if shipments is not None:
-        s = shipments.copy()
-        if 'order_id' in s.columns and dims.get('dates') is not None and 'shipped_at' in s.columns:
-            s['shipped_at'] = pd.to_datetime(s['shipped_at'], errors='coerce')
-            s = s.merge(dims['dates'][['date_sk','date']], left_on=pd.to_datetime(s['shipped_at']).dt.normalize(), right_on='date', how='left')
-            if 'date_sk' in s.columns:
-                s = s.rename(columns={'date_sk':'shipped_date_sk'})
-            s = s.drop(columns=[col for col in ('key_0','date') if col in s.columns])
+        s = shipments
+        if 'order_id' in s.columns and date_sk_by_id is not None and 'shipped_at' in s.columns:
+            s['shipped_date_sk'] = to_date_id(s['shipped_at']).map(date_sk_by_id)
         cols = [c for c in ['shipment_id','order_id','shipped_date_sk','carrier','status','tracking_number'] if c in s.columns]
-        fact_ship = s[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_ship = s[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_ship, 'fact_shipments')
     else:
         print('[warn] no hay shipment para crear fact_shipments')
 
-    # fact_web_sessions
+
+def _build_fact_web_sessions(date_sk_by_id):
     ws = read_staging('web_session')
     if ws is not None:
-        w = ws.copy()
-        if 'started_at' in w.columns and dims.get('dates') is not None:
-            w['started_at'] = pd.to_datetime(w['started_at'], errors='coerce')
-            w = w.merge(dims['dates'][['date_sk','date']], left_on=pd.to_datetime(w['started_at']).dt.normalize(), right_on='date', how='left')
-            if 'date_sk' in w.columns:
-                w = w.rename(columns={'date_sk':'session_date_sk'})
-            w = w.drop(columns=[col for col in ('key_0','date') if col in w.columns])
+        w = ws
+        if 'started_at' in w.columns and date_sk_by_id is not None:
+            w['session_date_sk'] = to_date_id(w['started_at']).map(date_sk_by_id)
         cols = [c for c in ['session_id','customer_id','session_date_sk','page_views','duration_seconds'] if c in w.columns]
-        fact_ws = w[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_ws = w[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_ws, 'fact_web_sessions')
     else:
         print('[warn] no hay web_session para crear fact_web_sessions')
 
-    # fact_nps
+
+def _build_fact_nps(date_sk_by_id):
     nps = read_staging('nps_response')
     if nps is not None:
-        n = nps.copy()
-        if 'response_date' in n.columns and dims.get('dates') is not None:
-            n['response_date'] = pd.to_datetime(n['response_date'], errors='coerce')
-            n = n.merge(dims['dates'][['date_sk','date']], left_on=pd.to_datetime(n['response_date']).dt.normalize(), right_on='date', how='left')
-            if 'date_sk' in n.columns:
-                n = n.rename(columns={'date_sk':'response_date_sk'})
-            n = n.drop(columns=[col for col in ('key_0','date') if col in n.columns])
+        n = nps
+        if 'response_date' in n.columns and date_sk_by_id is not None:
+            n['response_date_sk'] = to_date_id(n['response_date']).map(date_sk_by_id)
         cols = [c for c in ['nps_id','customer_id','response_date_sk','score','comment'] if c in n.columns]
-        fact_nps = n[cols].copy().drop_duplicates().reset_index(drop=True)
+        fact_nps = n[cols].drop_duplicates().reset_index(drop=True)
         write_table(fact_nps, 'fact_nps')
     else:
         print('[warn] no hay nps_response para crear fact_nps')
 
 
+def build_facts(dims):
+    # lookup date_id (YYYYMMDD) -> date_sk, compartido por todos los hechos
+    date_sk_by_id = None
+    if dims.get('dates') is not None:
+        date_sk_by_id = dict(zip(dims['dates']['date_id'].to_numpy(), dims['dates']['date_sk'].to_numpy()))
+
+    # cada hecho se arma en su propia función: sus intermedios se liberan al retornar,
+    # y el staging que ya no se usa sale del cache para acotar el pico de memoria
+    _build_fact_order_lines(dims, date_sk_by_id)
+    _build_fact_orders(dims, date_sk_by_id)
+    _release_staging('order_items', 'sales_order_item', 'orders', 'sales_order')
+    _build_fact_payments(date_sk_by_id)
+    _release_staging('payment')
+    _build_fact_shipments(date_sk_by_id)
+    _release_staging('shipment')
+    _build_fact_web_sessions(date_sk_by_id)
+    _release_staging('web_session')
+    _build_fact_nps(date_sk_by_id)
+    _release_staging('nps_response')
+
+
 def main():
     print(f"[start] STAGING_DIR={STAGING_DIR} -> DWH_DIR={DWH_DIR}")
     dims = build_dimensions()